@@ -26,20 +26,20 @@ from difflib import SequenceMatcher
 
 import terminal
 
+_ansi_reset = '\033[0m'
+
+# any character besides word characters, spaces and line endings
+_special_char = re.compile(r'[^\w \r\n]')
+
+# line type by first character, anything else is plain
+_line_types = {"@": "diffstuff", "+": "newtext", "-": "oldtext"}
+
 class LineParser(object):
     def parse_line(self, line):
-        if line.startswith("@"):
-            return "diffstuff"
-        elif line.startswith("+++ ") or line.startswith("--- "):
+        line_type = _line_types.get(line[:1], "plain")
+        if line_type != "plain" and line.startswith(("+++ ", "--- ")):
             return "metaline"
-        elif line.startswith("+"):
-            return "newtext"
-        elif line.startswith("-"):
-            return "oldtext"
-        elif line.startswith(" "):
-            return "plain"
-        else:
-            return "plain"
+        return line_type
 
 
 class DiffWriter(object):
@@ -49,6 +49,8 @@ class DiffWriter(object):
         self.lp = LineParser()
         self.oldtext_hold = None
         self.chunks = []
+        self._ansi_codes = {}
+        self._inline_matcher = SequenceMatcher(None, '', '')
         self.color = 'always' == color or ('auto' == color and terminal.has_ansi_colors())
         if self.color:
             self.colors = {
@@ -111,29 +113,41 @@ class DiffWriter(object):
 
             self.colors[key] = val
 
+    def _ansi_colorstring(self, text, fgcolor=None, bgcolor=None):
+        # same as terminal.colorstring, but the escape code is only built once
+        # for every color pair
+        code = self._ansi_codes.get((fgcolor, bgcolor))
+        if code is None:
+            code = terminal.colorstring('', fgcolor, bgcolor)[:-len(_ansi_reset)]
+            self._ansi_codes[fgcolor, bgcolor] = code
+        return code + text + _ansi_reset
+
     def colorstring(self, type, line, bgcolor_if_space=False, bgcolor=None):
-        color = self.colors[type]
+        colors = self.colors
+        color = colors[type]
         if color is not None:
             if ('newtext' == type or 'newsame' == type) and line.endswith('\n'):
-                bad_ws_match = re.match(r'^(.*?)([\t ]+)(\r?\n)$',
-                                        line)
-                if bad_ws_match:
-                    return ''.join(terminal.colorstring(txt, color, bcol)
-                        for txt, bcol in (
-                            (bad_ws_match.group(1), bgcolor),
-                            (bad_ws_match.group(2), self.colors['trailingspace'])
-                        )) + bad_ws_match.group(3)
+                # split off trailing whitespace and the line ending
+                eol = len(line) - 2 if line.endswith('\r\n') else len(line) - 1
+                text = line[:eol].rstrip('\t ')
+                if len(text) < eol and '\n' not in text:
+                    return (self._ansi_colorstring(text, color, bgcolor)
+                            + self._ansi_colorstring(line[len(text):eol], color,
+                                                     colors['trailingspace'])
+                            + line[eol:])
             elif 'diffstuff' == type:
-                diffstuff_match = re.match(r'^(@@[^@]*@@)(.*\r?\n)$',
-                                        line)
-                if diffstuff_match:
-                    return (terminal.colorstring(diffstuff_match.group(1), color)
-                            + diffstuff_match.group(2))
+                # color the '@@ -l,s +l,s @@' part, not the function name after it
+                end = line.find('@', 2) + 2
+                if (line.startswith('@@') and line.startswith('@@', end - 2)
+                        and line.endswith('\n') and '\n' not in line[end:-1]):
+                    return self._ansi_colorstring(line[:end], color) + line[end:]
             elif bgcolor_if_space and line.isspace() and not line.endswith('\n'):
                 bgcolor = color
-            return terminal.colorstring(str(line), color, bgcolor)
+            if not isinstance(line, str):
+                line = str(line)
+            return self._ansi_colorstring(line, color, bgcolor)
         else:
-            return str(line)
+            return line if isinstance(line, str) else str(line)
 
     def write(self, text):
         newstuff = text.split('\n')
@@ -165,16 +179,17 @@ class DiffWriter(object):
                 output.append(self.colorstring(line_type, line))
             self.target.writelines(output)
         else:
-            self.target.writelines(line)
+            self.target.write(line)
 
     def flush(self):
         if None != self.oldtext_hold:
-            self.target.writelines(self.colorstring('oldtext', self.oldtext_hold))
+            self.target.write(self.colorstring('oldtext', self.oldtext_hold))
             self.oldtext_hold = None
         self.target.flush()
 
     def parse_changed_line(self, oldtext, newtext):
-        s = SequenceMatcher(None, oldtext[1:], newtext[1:])
+        s = self._inline_matcher
+        s.set_seqs(oldtext[1:], newtext[1:])
         # only color changes when enough matches found, related to how klondiff tests it
         if sum(m[2] for m in s.get_matching_blocks()) > 0.6 * min(len(oldtext), len(newtext)): #s.quick_ratio() > 0.6 and s.ratio() > 0.6:
             oldtext = oldtext[1:]
@@ -183,7 +198,7 @@ class DiffWriter(object):
             # filter matches on minimum length or at least one special character,
             # the last match alway has lenght 0 and must be included too
             matches = [m for m in matches if m[2] == 0 or m[2] >= 4
-                       or re.search('[^\w \r\n]', oldtext[m[0]:m[0]+m[2]])]
+                       or _special_char.search(oldtext, m[0], m[0]+m[2])]
             old = [self.colorstring('oldtext', '-')]
             new = [self.colorstring('newtext', '+')]
             old.append(self.colorstring('oldtext', oldtext[0:matches[0][0]], bgcolor_if_space=True))
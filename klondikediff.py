@@ -19,10 +19,45 @@ from __future__ import absolute_import
 
 from bisect import bisect
 import difflib
+from itertools import takewhile
+import operator
 import re
 
 import myersdiff
 
+try:
+    from itertools import accumulate
+except ImportError:
+    # python 2
+    def accumulate(iterable):
+        total = 0
+        for x in iterable:
+            total += x
+            yield total
+
+try:
+    # python 2, a lazy map so _common_prefix can stop at the first difference
+    from itertools import imap as map
+except ImportError:
+    pass
+
+_repeats = re.compile(r'(.)\1\1+')
+# arguments for str.translate deleting whitespace, python 2 byte strings
+# take the characters to delete instead of a table
+if str is bytes:
+    _whitespace = (None, ' \t\r\n')
+else:
+    _whitespace = (str.maketrans('', '', ' \t\r\n'),)
+
+def _clear_junk(line):
+    r"""Remove whitespace and shorten runs of 3+ repeating characters to 2.
+
+    Same as re.sub(r'(.)\1*(?=\1{2})|[ \t\r\n]*', '', line), but the
+    whitespace is removed by str.translate, and runs are shortened first so
+    whitespace doesn't join runs that weren't there.
+    """
+    return _repeats.sub(r'\1\1', line).translate(*_whitespace)
+
 # function copied from Bram Cohen's Patience diff from bzr
 def unique_lcs_py(a, b):
     """Find the longest common subset for unique lines.
@@ -41,12 +76,11 @@ def unique_lcs_py(a, b):
     # set index[line in a] = position of line in a unless
     # a is a duplicate, in which case it's set to None
     index = {}
-    for i in range(len(a)):
-        line = a[i]
+    for i, line in enumerate(a):
         if line in index:
             index[line] = None
         else:
-            index[line]= i
+            index[line] = i
     # make btoa[i] = position of line i in a, unless
     # that line doesn't occur exactly once in both,
     # in which case it's set to None
@@ -69,6 +103,8 @@ def unique_lcs_py(a, b):
     stacks = []
     lasts = []
     k = 0
+    # local name, saves a global lookup per call in the loop below
+    _bisect = bisect
     for bpos, apos in enumerate(btoa):
         if apos is None:
             continue
@@ -82,7 +118,7 @@ def unique_lcs_py(a, b):
                                               stacks[k+1] > apos):
             k += 1
         else:
-            k = bisect(stacks, apos)
+            k = _bisect(stacks, apos)
         if k > 0:
             backpointers[bpos] = lasts[k-1]
         if k < len(stacks):
@@ -93,14 +129,29 @@ def unique_lcs_py(a, b):
             lasts.append(bpos)
     if len(lasts) == 0:
         return []
-    result = []
+    # the chain of backpointers visits exactly one entry of every stack,
+    # so the result can be filled in from the end
+    n = len(lasts)
+    result = [None] * n
     k = lasts[-1]
     while k is not None:
-        result.append((btoa[k], k))
+        n -= 1
+        result[n] = (btoa[k], k)
         k = backpointers[k]
-    result.reverse()
     return result
 
+# use the compiled version from patiencediff when available
+try:
+    from patiencediff import unique_lcs
+except ImportError:
+    unique_lcs = unique_lcs_py
+
+
+def _common_prefix(a, b):
+    """Return the number of leading items which are equal in a and b."""
+    # comparing and counting both run in C, no Python level loop
+    return sum(takewhile(bool, map(operator.eq, a, b)))
+
 
 def _check_consistency(answer):
     # For consistency sake, make sure all matches are only increasing
@@ -127,6 +178,17 @@ class KlondikeSequenceMatcher(difflib.SequenceMatcher):
         difflib.SequenceMatcher.__init__(self, isjunk, a, b)
         self.extra_effort = extra_effort
 
+    def set_seq1(self, a):
+        # the junk stripped lines are cached per sequence
+        if a is not self.a:
+            self.a_ws = None
+        difflib.SequenceMatcher.set_seq1(self, a)
+
+    def set_seq2(self, b):
+        if b is not self.b:
+            self.b_ws = None
+        difflib.SequenceMatcher.set_seq2(self, b)
+
     def get_matching_blocks(self):
         """Return list of triples describing matching subsequences.
 
@@ -151,37 +213,50 @@ class KlondikeSequenceMatcher(difflib.SequenceMatcher):
         if self.matching_blocks is not None:
             return self.matching_blocks
 
-        # remove whitespace and repeated characters
-        clear_junk = re.compile(r'(.)\1*(?=\1{2})|[ \t\r\n]*')
-        self.a_ws = a_ws = [clear_junk.sub('', s) for s in self.a]
-        self.b_ws = b_ws = [clear_junk.sub('', s) for s in self.b]
+        # remove whitespace and repeated characters, each distinct line is
+        # only cleared once as most lines are repeated or occur in both a and b
+        if self.a_ws is None or self.b_ws is None:
+            lines = set()
+            if self.a_ws is None:
+                lines.update(self.a)
+            if self.b_ws is None:
+                lines.update(self.b)
+            cleared = {s: _clear_junk(s) for s in lines}
+            if self.a_ws is None:
+                self.a_ws = list(map(cleared.__getitem__, self.a))
+            if self.b_ws is None:
+                self.b_ws = list(map(cleared.__getitem__, self.b))
+        a_ws, b_ws = self.a_ws, self.b_ws
         #a_ws = [s.strip().replace(' ','').replace('\t','') for s in self.a]
         #b_ws = [s.strip().replace(' ','').replace('\t','') for s in self.b]
         # TODO: more junk stripping?
 
         # first match blocks at beginning and end of file
-        min_len = min(len(a_ws), len(b_ws))
-        start_line = 0
-        while start_line < min_len and a_ws[start_line] == b_ws[start_line]:
-            start_line += 1
-        end_line = -1
-        while end_line >= -min_len and a_ws[end_line] == b_ws[end_line]:
-            end_line -= 1
-        end_line += 1
+        start_line = _common_prefix(a_ws, b_ws)
+        if start_line == len(a_ws) == len(b_ws):
+            # nothing but junk changes, no need to look any further
+            matches = [(0, 0, start_line)] if start_line else []
+            matches.append( (start_line, start_line, 0) )
+            self.matching_blocks = matches
+            return self.matching_blocks
+        end_line = -_common_prefix(reversed(a_ws), reversed(b_ws))
         if end_line == 0:
             # use None for slicing till the end
             end_line = None
 
         # in the rest find LCS of unique lines
-        result = unique_lcs_py(a_ws[start_line:end_line], b_ws[start_line:end_line])
-        result = [(apos + start_line, bpos + start_line) for apos, bpos in result]
+        result = unique_lcs(a_ws[start_line:end_line], b_ws[start_line:end_line])
 
         # grow unique matches with surrounding lines
         matches = []
+        append = matches.append
         if start_line:
-            matches.append((0, 0, start_line))
+            append((0, 0, start_line))
         last_a = last_b = start_line
         for apos, bpos in result:
+            # result is relative to start_line
+            apos += start_line
+            bpos += start_line
             # if previous match overlaps current just skip it.
             # Only a is checked because lines are unique anyway
             # TODO: check if <= is correct, print((apos-last_a,bpos-last_b))
@@ -203,26 +278,27 @@ class KlondikeSequenceMatcher(difflib.SequenceMatcher):
                 in_matches = myersdiff.MyersSequenceMatcher(None, a_ws[last_a:apos+start], b_ws[last_b:bpos+start]).get_matching_blocks()
                 matches.extend([(a+last_a, b+last_b, s) for a,b,s in in_matches if s])
 
-            matches.append((apos + start, bpos + start, end - start))
+            append((apos + start, bpos + start, end - start))
             last_a = apos + end
             last_b = bpos + end
 
         if end_line != None:
-            matches.append( (len(a_ws) + end_line, len(b_ws) + end_line, -end_line) )
+            append( (len(a_ws) + end_line, len(b_ws) + end_line, -end_line) )
 
         # add dummy tuple
-        matches.append( (len(a_ws), len(b_ws), 0) )
+        append( (len(a_ws), len(b_ws), 0) )
 
         # check for same lines before and after change
         for n, (apos, bpos, size) in enumerate(matches[:-1]):
-            d = max(apos + size - matches[n+1][0], bpos + size - matches[n+1][1])
+            next_a, next_b, next_size = matches[n+1]
+            d = max(apos + size - next_a, bpos + size - next_b)
             if d > 0:
                 for k in range(d): # shift change to go untill empty line, if possible
-                    if a_ws[matches[n+1][0] + d - k - 1] == '':
+                    if a_ws[next_a + d - k - 1] == '':
                         matches[n] = (matches[n][0], matches[n][1], matches[n][2] - k)
                         d -= k
                         break
-                matches[n+1] = (matches[n+1][0] + d, matches[n+1][1] + d, matches[n+1][2] - d)
+                matches[n+1] = (next_a + d, next_b + d, next_size - d)
 
         self.matching_blocks = matches
 
@@ -273,6 +349,7 @@ class KlondikeSequenceMatcher(difflib.SequenceMatcher):
             return (tag,) + t
         i = j = 0
         self.opcodes = answer = []
+        append = answer.append
         for ai, bj, size in self.get_matching_blocks():
 
             # invariant:  we've pumped out correct diffs to change
@@ -288,7 +365,11 @@ class KlondikeSequenceMatcher(difflib.SequenceMatcher):
                 if self.extra_effort and (i < ai - 1 or j < bj - 1):
                     a = 'a\n'.join(self.a_ws[i:ai])
                     b = 'b\n'.join(self.b_ws[j:bj])
-                    cur_a = cur_b = 0
+                    # line lengths in the joined strings, including separator,
+                    # and the offsets where the lines end
+                    a_lens = [len(s) + 2 for s in self.a_ws[i:ai]]
+                    a_ends = list(accumulate(a_lens))
+                    b_ends = list(accumulate(len(s) + 2 for s in self.b_ws[j:bj]))
                     cur_an = cur_bn = 0
                     prev_an = prev_bn = 0
                     prev_m2 = 0
@@ -296,21 +377,21 @@ class KlondikeSequenceMatcher(difflib.SequenceMatcher):
                     for m in matches:
                         if m[2] >= 3: # only act when match is long enough
                             # find line numbers of match
-                            while cur_a <= m[0] + 1:
-                                cur_a += len(self.a_ws[i+cur_an]) + 2
-                                cur_an += 1
+                            n = bisect(a_ends, m[0] + 1) + 1
+                            if n > cur_an:
+                                cur_an = n
                                 prev_m2 = 0
-                            while cur_b <= m[1] + 1:
-                                cur_b += len(self.b_ws[j+cur_bn]) + 2
-                                cur_bn += 1
+                            n = bisect(b_ends, m[1] + 1) + 1
+                            if n > cur_bn:
+                                cur_bn = n
                                 prev_m2 = 0
                             if prev_an < cur_an and prev_bn < cur_bn:
                                 # if too little overlap between lines skip match
-                                if m[2] + prev_m2 <= 0.6 * min(len(self.a_ws[i + cur_an - 1]), len(self.b[j + cur_bn - 1])):
+                                if m[2] + prev_m2 <= 0.6 * min(a_lens[cur_an - 1] - 2, len(self.b[j + cur_bn - 1])):
                                     prev_m2 += m[2]
                                     continue
                                 if prev_an < cur_an - 1 or prev_bn < cur_bn - 1:
-                                    answer.append( add_tag((
+                                    append( add_tag((
                                         i + prev_an, i + cur_an - 1,
                                         j + prev_bn, j + cur_bn - 1 )) )
                                 # extra check if replaced lines are equal, sometimes happens somehow
@@ -320,13 +401,13 @@ class KlondikeSequenceMatcher(difflib.SequenceMatcher):
                                     tag = 'equal'
                                 else:
                                     tag = 'replace'
-                                answer.append( (tag,
+                                append( (tag,
                                     i + cur_an - 1, i + cur_an,
                                     j + cur_bn - 1, j + cur_bn) )
                                 prev_an, prev_bn = cur_an, cur_bn
 
                     if i + prev_an < ai or j + prev_bn < bj:
-                        answer.append( add_tag((
+                        append( add_tag((
                             i + prev_an, ai,
                             j + prev_bn, bj)) )
                     tag = ''
@@ -335,19 +416,26 @@ class KlondikeSequenceMatcher(difflib.SequenceMatcher):
             elif j < bj:
                 tag = 'insert'
             if tag:
-                answer.append( (tag, i, ai, j, bj) )
+                append( (tag, i, ai, j, bj) )
             i, j = ai+size, bj+size
 
-            # check matches for junk changes
+            # check matches for junk changes, most blocks have none
+            if self.a[ai:i] == self.b[bj:j]:
+                if size:
+                    append( ('equal', ai, i, bj, j) )
+                continue
+            # flag the changed lines and jump between them with find
+            changed = bytearray(map(operator.ne, self.a[ai:i], self.b[bj:j]))
             n1 = 0
-            for n in range(size):
-                if self.a[ai + n] != self.b[bj + n]:
-                    if n1 < n:
-                        answer.append( ('equal', ai + n1, ai + n, bj + n1, bj + n) )
-                    n1 = n + 1
-                    answer.append( ('replace', ai + n, ai + n + 1, bj + n, bj + n + 1) )
+            n = changed.find(b'\x01')
+            while n != -1:
+                if n1 < n:
+                    append( ('equal', ai + n1, ai + n, bj + n1, bj + n) )
+                n1 = n + 1
+                append( ('replace', ai + n, ai + n + 1, bj + n, bj + n + 1) )
+                n = changed.find(b'\x01', n1)
             if n1 < size:
-                answer.append( ('equal', ai + n1, ai + size, bj + n1, bj + size) )
+                append( ('equal', ai + n1, ai + size, bj + n1, bj + size) )
 
         # sanity check if both documents are fully covered
         errors = []
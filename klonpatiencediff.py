@@ -15,9 +15,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
-import sys
-PY3 = sys.version_info[0] == 3
-
+from bisect import bisect_left
+from itertools import chain
 import os
 import sys
 import time
@@ -31,14 +30,10 @@ __all__ = ['PatienceSequenceMatcher', 'unified_diff', 'unified_diff_files']
 ###  Binary file test
 ########################################################################
 
-# A function that takes an integer in the 8-bit range and returns
-# a single-character byte object in py3 / a single-character string
-# in py2.
-#
-int2byte = (lambda x: bytes((x,))) if PY3 else chr
-
+# Printable ASCII and the common control characters of text files.
+# bytes(bytearray(...)) gives a byte string in both py2 and py3.
 _text_characters = (
-        b''.join(int2byte(i) for i in range(32, 127)) +
+        bytes(bytearray(range(32, 127))) +
         b'\n\r\t\f\b')
 
 def istext(block):
@@ -59,7 +54,7 @@ def istext(block):
     nontext = block.translate(None, _text_characters)
     return float(len(nontext)) / len(block) <= 0.30
 
-def binary_test(file1, file2, blocksize=512):
+def binary_test(file1, file2, blocksize=512, cmp_blocksize=65536):
     with open(file1, 'rb') as f1:
         with open(file2, 'rb') as f2:
             block1 = f1.read(blocksize)
@@ -68,9 +63,10 @@ def binary_test(file1, file2, blocksize=512):
             if istext(block1) and istext(block2):
                 return 'text'
 
+            # binary files can be large, compare the rest in bigger blocks
             while block1 and block2 and block1 == block2:
-                block1 = f1.read(blocksize)
-                block2 = f2.read(blocksize)
+                block1 = f1.read(cmp_blocksize)
+                block2 = f2.read(cmp_blocksize)
 
             if block1 or block2:
                 return 'binary_different'
@@ -85,20 +81,18 @@ def binary_test(file1, file2, blocksize=512):
 def _format_range_unified(start, stop):
     'Convert range to the "ed" format'
     # Per the diff spec at http://www.unix.org/single_unix_specification/
-    beginning = start + 1     # lines start numbering with one
     length = stop - start
     if length == 1:
-        return '{}'.format(beginning)
-    if not length:
-        beginning -= 1        # empty ranges begin at line just before the range
-    return '{},{}'.format(beginning, length)
+        return '%d' % (start + 1)  # lines start numbering with one
+    # empty ranges begin at line just before the range
+    return '%d,%d' % (start + 1 if length else start, length)
 
 # This is a version of unified_diff which only adds a factory parameter
 # so that you can override the default SequenceMatcher
 # this has been submitted as a patch to python
 def unified_diff(a, b, fromfile='', tofile='', fromfiledate='',
                  tofiledate='', n=3, lineterm='\n',
-                 sequencematcher=None, function_regexp=r'^\w'):
+                 sequencematcher=difflib.SequenceMatcher, function_regexp=r'^\w'):
     r"""
     Compare two sequences of lines; generate the delta as a unified diff.
 
@@ -137,30 +131,33 @@ def unified_diff(a, b, fromfile='', tofile='', fromfiledate='',
     +tree
      four
     """
-    if sequencematcher is None:
-        sequencematcher = difflib.SequenceMatcher
+    # None also means difflib, as it did before it became the default
+    sequencematcher = sequencematcher or difflib.SequenceMatcher
+
+    groups = iter(sequencematcher(None,a,b).get_grouped_opcodes(n))
+    first_group = next(groups, None)
+    if first_group is None:
+        return
 
+    fromdate = '\t{}'.format(fromfiledate) if fromfiledate else ''
+    todate = '\t{}'.format(tofiledate) if tofiledate else ''
+    yield '--- {}{}{}'.format(fromfile, fromdate, lineterm)
+    yield '+++ {}{}{}'.format(tofile, todate, lineterm)
+
+    # only scan for function lines when there is a hunk to show
     function_lines = []
     if function_regexp:
-        function_regexp = re.compile(function_regexp)
-        function_lines = [k for k, line in enumerate(a) if function_regexp.match(line)]
-        current_function = 0
-
-    started = False
-    for group in sequencematcher(None,a,b).get_grouped_opcodes(n):
-        if not started:
-            started = True
-            fromdate = '\t{}'.format(fromfiledate) if fromfiledate else ''
-            todate = '\t{}'.format(tofiledate) if tofiledate else ''
-            yield '--- {}{}{}'.format(fromfile, fromdate, lineterm)
-            yield '+++ {}{}{}'.format(tofile, todate, lineterm)
+        # re.compile returns already compiled patterns as is, and caches the rest
+        match = re.compile(function_regexp).match
+        function_lines = [k for k, m in enumerate(map(match, a)) if m]
 
+    for group in chain([first_group], groups):
         first, last = group[0], group[-1]
         file1_range = _format_range_unified(first[1], last[2])
         file2_range = _format_range_unified(first[3], last[4])
         if function_lines:
-            while current_function < len(function_lines) and function_lines[current_function] < first[1] + n:
-                current_function += 1
+            # the last function line before the first changed line
+            current_function = bisect_left(function_lines, first[1] + n)
             if current_function > 0:
                 function = ' ' + a[function_lines[current_function - 1]].rstrip()
             else:
@@ -173,16 +170,20 @@ def unified_diff(a, b, fromfile='', tofile='', fromfiledate='',
             if tag == 'equal':
                 for line in a[i1:i2]:
                     yield ' ' + line
-                continue
-            if tag in ('replace', 'delete'):
+            elif tag == 'delete':
+                for line in a[i1:i2]:
+                    yield '-' + line
+            elif tag == 'insert':
+                for line in b[j1:j2]:
+                    yield '+' + line
+            else:
                 for line in a[i1:i2]:
                     yield '-' + line
-            if tag in ('replace', 'insert'):
                 for line in b[j1:j2]:
                     yield '+' + line
 
 
-def unified_diff_files(a, b, sequencematcher=None, displaynames=None):
+def unified_diff_files(a, b, sequencematcher=difflib.SequenceMatcher, displaynames=None):
     """Generate the diff for two files.
     """
     # Should this actually be an error?
@@ -196,25 +197,26 @@ def unified_diff_files(a, b, sequencematcher=None, displaynames=None):
         aname = a
         bname = b
 
-    if a == '-':
-        file_a = sys.stdin
-        time_a = time.time()
-    else:
-        file_a = open(a, 'r')
-        time_a = os.stat(a).st_mtime
-
-    if b == '-':
-        file_b = sys.stdin
-        time_b = time.time()
-    else:
-        file_b = open(b, 'r')
-        time_b = os.stat(b).st_mtime
+    lines_a, time_a = _read_lines(a)
+    lines_b, time_b = _read_lines(b)
+    # identical content, no need to run the matcher
+    if lines_a == lines_b:
+        return []
 
     # TODO: Include fromfiledate and tofiledate if displaynames is not set
-    return unified_diff(file_a.readlines(), file_b.readlines(),
+    return unified_diff(lines_a, lines_b,
                         fromfile=aname, tofile=bname,
                         sequencematcher=sequencematcher)
 
+
+def _read_lines(path):
+    """Return the lines and modification time of a file, '-' is stdin."""
+    if path == '-':
+        return sys.stdin.readlines(), time.time()
+    # one large buffer instead of many default sized reads for big files
+    with open(path, 'r', 1 << 20) as f:
+        return f.readlines(), os.fstat(f.fileno()).st_mtime
+
 from patiencediff import (
     unique_lcs,
     recurse_matches,
@@ -250,7 +252,7 @@ def main(args):
 
     colordiff_writer = colordiff.DiffWriter(sys.stdout, color='always')
     def print_color(type, line):
-        colordiff_writer.target.writelines(colordiff_writer.colorstring(type, line) + '\n')
+        colordiff_writer.target.write(colordiff_writer.colorstring(type, line) + '\n')
 
     # check for git external diff syntax
     # TODO: check if git header is correct, old/new mode isn't handled